@@ -1,9 +1,17 @@
+import itertools
 import re
+import string
+from collections.abc import Mapping
 from datetime import datetime
 from enum import Enum, IntEnum
-from typing import Literal
+from functools import cached_property
+from typing import Any, Literal
 
-from pydantic import BaseModel, Field, computed_field, field_validator, model_validator
+from pydantic import BaseModel, ConfigDict, Field, field_validator, model_validator
+from typing_extensions import Self
+
+# split only at the commas that really separate test-result pairs
+_CHUNK_SPLIT_RE = re.compile(r",\s*(?=[^,:]+?:)", re.M)
 
 
 class Color(IntEnum):
@@ -12,6 +20,10 @@ class Color(IntEnum):
     Red = 3
 
 
+_RED = Color.Red
+_YELLOW = Color.Yellow
+
+
 class ClinicalDecisionRule(Enum):
     TreatmentRecommendation = "Treatment Recommendation"
     DiagnosisEvaluation = "Diagnosis Evaluation"
@@ -20,15 +32,35 @@ class ClinicalDecisionRule(Enum):
     InvestigationRecommendations = "Investigation Recommendations"
 
 
+_COLOR_BY_NAME = {c.name: c for c in Color}
+
+
 def global_validate_severity(v):
     if isinstance(v, str):
         try:
-            return Color[v]
+            return _COLOR_BY_NAME[v]
         except KeyError as e:
             raise ValueError(f"Invalid severity: {v}") from e
+    return v
+
+
+class _FrozenModel(BaseModel):
+    """Base for the read-only models; derived values are memoised with cached_property."""
+
+    model_config = ConfigDict(frozen=True, extra="ignore")
+
+    def model_copy(self, *, update: Mapping[str, Any] | None = None, deep: bool = False) -> Self:
+        copied = super().model_copy(update=update, deep=deep)
+        if update:
+            # cached values were computed from the old fields, so recompute them on demand
+            for klass in type(self).__mro__:
+                for name, attr in vars(klass).items():
+                    if isinstance(attr, cached_property):
+                        copied.__dict__.pop(name, None)
+        return copied
 
 
-class ResponseValue(BaseModel):
+class ResponseValue(_FrozenModel):
     severity: Color = Field(validation_alias="Severity")
     reason: str = Field(validation_alias="Reason")
 
@@ -37,7 +69,7 @@ class ResponseValue(BaseModel):
         return global_validate_severity(v)
 
 
-class RecommendationValue(BaseModel):
+class RecommendationValue(_FrozenModel):
     severity: Color = Field(validation_alias="Severity")
     action: str = Field(validation_alias="Action")
 
@@ -46,20 +78,24 @@ class RecommendationValue(BaseModel):
         return global_validate_severity(v)
 
 
-class AIResponse(BaseModel):
+class AIResponse(_FrozenModel):
     responses: list[ResponseValue] = Field(validation_alias="Response")
     recommendations: list[RecommendationValue] = Field(validation_alias="Recommendations")
 
+    @cached_property
+    def all_severities(self) -> tuple[Color, ...]:
+        return tuple(r.severity for r in itertools.chain(self.responses, self.recommendations))
+
     @model_validator(mode="after")
     def check_nonempty(cls, values):
-        if not values.responses and not values.recommendations:
+        if not values.all_severities:
             raise ValueError(
                 "AIResponse must have at least one response value or at least one recommendation value"
             )
         return values
 
 
-class AICall(BaseModel):
+class AICall(_FrozenModel):
     rule: ClinicalDecisionRule
     response: AIResponse
     user_id: str
@@ -69,16 +105,13 @@ class AICall(BaseModel):
     silent: Literal["Active", "Silent"]
     acknowledged: bool | None = None
 
-    @property
+    @cached_property
     def color(self) -> Color:
         """We define the color of an AICall as the worst severity of the response or recommendation"""
-        response_colors = {r.severity for r in self.response.responses}
-        recommendation_colors = {r.severity for r in self.response.recommendations}
-        all_colors = response_colors | recommendation_colors
-        return max(all_colors)
+        return Color(max(self.response.all_severities))
 
 
-class AICalls(BaseModel):
+class AICalls(_FrozenModel):
     calls: list[AICall]
     rule: ClinicalDecisionRule | None = None
 
@@ -86,28 +119,24 @@ class AICalls(BaseModel):
         return not self.calls
 
     def for_rule(self, rule: ClinicalDecisionRule) -> "AICalls":
-        relevant_calls = [call for call in self.calls if call.rule == rule]
-        return AICalls(calls=relevant_calls, rule=rule)
+        # the calls were validated when self was built, so the filtered view skips re-validation
+        return AICalls.model_construct(calls=list(self._by_rule.get(rule, ())), rule=rule)
 
     def for_rules(self, rules: list[ClinicalDecisionRule]) -> "AICalls":
         relevant_calls = [call for call in self.calls if call.rule in rules]
-        return AICalls(calls=relevant_calls, rule=None)
+        return AICalls.model_construct(calls=relevant_calls, rule=None)
 
     @property
     def final(self) -> AICall | None:
         if self.rule is None:
             raise ValueError("The final call is not defined for an AICalls object with no rule")
-        if self._is_empty():
-            return None
-        return max(self.calls, key=lambda c: c.time)
+        return self._final_by_rule.get(self.rule)
 
     @property
     def first(self) -> AICall | None:
         if self.rule is None:
             raise ValueError("The first call is not defined for an AICalls object with no rule")
-        if self._is_empty():
-            return None
-        return min(self.calls, key=lambda c: c.time)
+        return self._first_by_rule.get(self.rule)
 
     @property
     def final_color(self) -> Color | None:
@@ -119,77 +148,108 @@ class AICalls(BaseModel):
         first = self.first
         return first.color if first else None
 
+    @cached_property
+    def _by_rule(self) -> dict[ClinicalDecisionRule, list[AICall]]:
+        buckets: dict[ClinicalDecisionRule, list[AICall]] = {}
+        for call in self.calls:
+            buckets.setdefault(call.rule, []).append(call)
+        return buckets
+
+    @cached_property
+    def _final_by_rule(self) -> dict[ClinicalDecisionRule, AICall]:
+        return {rule: max(calls, key=lambda c: c.time) for rule, calls in self._by_rule.items()}
+
+    @cached_property
+    def _first_by_rule(self) -> dict[ClinicalDecisionRule, AICall]:
+        return {rule: min(calls, key=lambda c: c.time) for rule, calls in self._by_rule.items()}
+
     def any_final_color(self, color: Color) -> bool:
-        final_colors_for_rules = {self.for_rule(rule).final_color for rule in ClinicalDecisionRule}
-        return color in final_colors_for_rules
+        return any(call.color == color for call in self._final_by_rule.values())
 
     def any_first_color(self, color: Color) -> bool:
-        first_colors_for_rules = {self.for_rule(rule).first_color for rule in ClinicalDecisionRule}
-        return color in first_colors_for_rules
+        return any(call.color == color for call in self._first_by_rule.values())
 
-    @property
-    def colors_seen(self) -> set[Color] | None:
+    @cached_property
+    def _colors_seen(self) -> frozenset[Color] | None:
         if self._is_empty():
             return None
         else:
-            return {call.color for call in self.calls}
+            return frozenset(call.color for call in self.calls)
 
     @property
+    def colors_seen(self) -> set[Color] | None:
+        colors = self._colors_seen
+        return None if colors is None else set(colors)
+
+    @cached_property
     def worst_color(self) -> Color | None:
-        colors = self.colors_seen
+        colors = self._colors_seen
         return max(colors) if colors else None
 
     def ever_had_color(self, color: Color) -> bool | None:
-        colors = self.colors_seen
-        return color in colors if colors else None
+        colors = self._colors_seen
+        return None if colors is None else color in colors
 
     def final_is_color(self, color: Color) -> bool | None:
         fc = self.final_color
-        return fc == color if fc else None
+        return None if fc is None else fc == color
 
     def first_is_color(self, color: Color) -> bool | None:
         fc = self.first_color
-        return fc == color if fc else None
+        return None if fc is None else fc == color
 
     # convenience properties
     @property
     def final_red(self) -> bool | None:
-        return self.final_is_color(Color.Red)
+        return self.final_is_color(_RED)
 
     @property
     def first_red(self) -> bool | None:
-        return self.first_is_color(Color.Red)
+        return self.first_is_color(_RED)
 
     @property
     def final_red_yellow(self) -> bool | None:
-        return self.final_is_color(Color.Red) or self.final_is_color(Color.Yellow)
+        fc = self.final_color
+        return None if fc is None else fc >= _YELLOW
 
     @property
     def ever_red(self) -> bool | None:
-        return self.ever_had_color(Color.Red)
+        return self.ever_had_color(_RED)
 
     @property
     def ever_red_yellow(self) -> bool | None:
-        return self.ever_had_color(Color.Red) or self.ever_had_color(Color.Yellow)
+        worst = self.worst_color
+        return None if worst is None else worst >= _YELLOW
 
     @property
     def any_final_red(self) -> bool | None:
-        return self.any_final_color(Color.Red)
+        return self.any_final_color(_RED)
 
     @property
     def any_first_red(self) -> bool | None:
-        return self.any_first_color(Color.Red)
+        return self.any_first_color(_RED)
 
     @property
     def any_final_red_yellow(self) -> bool | None:
-        return self.any_final_color(Color.Red) or self.any_final_color(Color.Yellow)
+        return any(call.color >= _YELLOW for call in self._final_by_rule.values())
 
 
-def format_not_recorded(template: str, entry: BaseModel) -> str:
-    entries = entry.model_dump()
-    for k, v in entries.items():
-        if v is None:
-            entries[k] = "Not recorded"
+def _template_fields(template: str) -> tuple[str, ...]:
+    return tuple(
+        field for _, field, _, _ in string.Formatter().parse(template) if field is not None
+    )
+
+
+def format_not_recorded(
+    template: str, entry: BaseModel, fields: tuple[str, ...] | None = None
+) -> str:
+    if fields is None:
+        fields = _template_fields(template)
+
+    entries = {}
+    for field in fields:
+        v = getattr(entry, field)
+        entries[field] = "Not recorded" if v is None else v
 
     return template.format(**entries).strip()
 
@@ -231,6 +291,11 @@ TREATMENT_TEMPLATE = """**Referrals:**
 **Medications:**
 {rx}"""
 
+HISTORY_FIELDS = _template_fields(HISTORY_TEMPLATE)
+INVESTIGATION_FIELDS = _template_fields(INVESTIGATION_TEMPLATE)
+DIAGNOSIS_FIELDS = _template_fields(DIAGNOSIS_TEMPLATE)
+TREATMENT_FIELDS = _template_fields(TREATMENT_TEMPLATE)
+
 
 INVESTIGATION_SUBFIELD_SORT_ORDER = {
     "Full Haemogram (FHG)": [
@@ -298,8 +363,37 @@ INVESTIGATION_SUBFIELD_SORT_ORDER = {
     ],
 }
 
+_SUBFIELD_RANK = {
+    name: {k: i for i, k in enumerate(order)}
+    for name, order in INVESTIGATION_SUBFIELD_SORT_ORDER.items()
+}
+
+
+def _format_investigation(name: str, value: str) -> str:
+    ranks = _SUBFIELD_RANK.get(name)
+
+    # result keys come first in document order, then known subfields in their usual order,
+    # then by name
+    items = []
+    for i, chunk in enumerate(_CHUNK_SPLIT_RE.split(value)):
+        k, sep, v = chunk.partition(":")  # only the first colon matters
+        if not sep:
+            raise ValueError(f"Investigation subfield without a colon: {chunk!r}")
+        k = k.strip()
+        if "result" in k.lower() and k.endswith("."):
+            items.append((0, i, k, v.strip()))
+        else:
+            items.append((1, ranks.get(k, 1 << 30) if ranks else 0, k, v.strip()))
+    items.sort()
 
-class ClinicalDocumentation(BaseModel):
+    parts = [f"{name}: "]
+    for _, _, k, v in items:
+        parts.append(f"\n* {k}: {v}")
+    parts.append("\n\n")
+    return "".join(parts)
+
+
+class ClinicalDocumentation(_FrozenModel):
     gender: str = Field(validation_alias="Gender")
     age: str = Field(validation_alias="Age")
     allergies: str | None = Field(validation_alias="Allergies", default=None)
@@ -323,8 +417,7 @@ class ClinicalDocumentation(BaseModel):
     doc_rr: float | None = Field(validation_alias="doc_rr", default=None)
     doc_sp2: float | None = Field(validation_alias="doc_sp2", default=None)
 
-    @computed_field
-    @property
+    @cached_property
     def lab_test_clean(self) -> str | None:
         s = self.lab_test
         if s is None:
@@ -337,56 +430,33 @@ class ClinicalDocumentation(BaseModel):
         s = s.replace("::", ":")
         investigation_list = s.split("\n\n")
 
-        formatted_string = ""
+        parts: list[str] = []
 
         for investigation in investigation_list:
-            investigation_name, investigation_value = investigation.split(":", maxsplit=1)
+            if not investigation.strip():
+                continue
+            investigation_name, sep, investigation_value = investigation.partition(":")
+            if not sep:
+                raise ValueError(f"Investigation without a colon: {investigation!r}")
             investigation_name = investigation_name.strip()
             investigation_value = investigation_value.strip()
 
-            investigation_substrings = {}
-
-            # split only at the commas that really separate test-result pairs
-            for chunk in re.split(r",\s*(?=[^,:]+?:)", investigation_value, flags=re.M):
-                key, value = chunk.split(":", 1)  # only the first colon matters
-                investigation_substrings[key.strip()] = value.strip()
-
-            formatted_string += f"{investigation_name}: "
-            result_keys = [
-                k
-                for k, v in investigation_substrings.items()
-                if "result" in k.lower() and k.endswith(".")
-            ]
-            for result_key in result_keys:
-                formatted_string += f"\n* {result_key}: {investigation_substrings[result_key]}"
-                del investigation_substrings[result_key]
-
-            if investigation_name in INVESTIGATION_SUBFIELD_SORT_ORDER:
-                sorted_keys = sorted(
-                    investigation_substrings.keys(),
-                    key=lambda x: INVESTIGATION_SUBFIELD_SORT_ORDER[investigation_name].index(x),
-                )
-            else:
-                sorted_keys = sorted(investigation_substrings.keys())
-
-            for k in sorted_keys:
-                formatted_string += f"\n* {k}: {investigation_substrings[k]}"
-            formatted_string += "\n\n"
-
-        return formatted_string
+            parts.append(_format_investigation(investigation_name, investigation_value))
+
+        return "".join(parts)
 
     @property
     def history(self) -> str:
-        return format_not_recorded(HISTORY_TEMPLATE, self)
+        return format_not_recorded(HISTORY_TEMPLATE, self, HISTORY_FIELDS)
 
     @property
     def investigations(self) -> str:
-        return format_not_recorded(INVESTIGATION_TEMPLATE, self)
+        return format_not_recorded(INVESTIGATION_TEMPLATE, self, INVESTIGATION_FIELDS)
 
     @property
     def diagnosis(self) -> str:
-        return format_not_recorded(DIAGNOSIS_TEMPLATE, self)
+        return format_not_recorded(DIAGNOSIS_TEMPLATE, self, DIAGNOSIS_FIELDS)
 
     @property
     def treatment(self) -> str:
-        return format_not_recorded(TREATMENT_TEMPLATE, self)
+        return format_not_recorded(TREATMENT_TEMPLATE, self, TREATMENT_FIELDS)